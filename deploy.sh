@@ -9,6 +9,11 @@ ENTRY_POINT="main"
 MEMORY="256MB"
 TIMEOUT="60s"
 MAX_INSTANCES="10"
+CPU="1"
+DATABASE_ID="adagio-teas-visitor-ids"
+# Requests per instance; THREADS gives functions-framework's gunicorn a
+# serving thread for each of them
+CONCURRENCY="80"
 
 # Check if gcloud is installed
 if ! command -v gcloud &> /dev/null; then
@@ -28,6 +33,72 @@ fi
 echo "Setting project to retail-api-397423..."
 gcloud config set project retail-api-397423
 
+# Create any composite indexes from firestore.indexes.json that don't exist yet
+echo "Ensuring Firestore indexes from firestore.indexes.json..."
+EXISTING_INDEXES=$(gcloud firestore indexes composite list --database=$DATABASE_ID --format=json)
+if [ $? -ne 0 ]; then
+    echo "❌ Could not list Firestore indexes for database $DATABASE_ID!"
+    exit 1
+fi
+
+# Print gcloud arguments for each declared index missing from the database
+MISSING_INDEXES=$(EXISTING_INDEXES="$EXISTING_INDEXES" python3 - <<'PYTHON'
+import json
+import os
+
+def index_key(collection_group, query_scope, fields):
+    return (
+        collection_group,
+        query_scope.upper(),
+        tuple(
+            (field["fieldPath"], field.get("order") or field.get("arrayConfig"))
+            for field in fields
+            if field["fieldPath"] != "__name__"
+        ),
+    )
+
+existing = {
+    index_key(index["name"].split("/")[-3], index["queryScope"], index["fields"])
+    for index in json.loads(os.environ["EXISTING_INDEXES"] or "[]")
+}
+
+with open("firestore.indexes.json") as f:
+    declared = json.load(f)["indexes"]
+
+for index in declared:
+    if index_key(index["collectionGroup"], index["queryScope"], index["fields"]) in existing:
+        continue
+    args = [
+        f"--collection-group={index['collectionGroup']}",
+        f"--query-scope={index['queryScope'].lower()}",
+    ]
+    for field in index["fields"]:
+        if "order" in field:
+            config = f"order={field['order'].lower()}"
+        else:
+            config = f"array-config={field['arrayConfig'].lower()}"
+        args.append(f"--field-config=field-path={field['fieldPath']},{config}")
+    print(" ".join(args))
+PYTHON
+)
+if [ $? -ne 0 ]; then
+    echo "❌ Could not read firestore.indexes.json!"
+    exit 1
+fi
+
+if [ -z "$MISSING_INDEXES" ]; then
+    echo "All Firestore indexes already exist."
+fi
+while read -r INDEX_ARGS; do
+    [ -z "$INDEX_ARGS" ] && continue
+    echo "Creating Firestore index: $INDEX_ARGS"
+    gcloud firestore indexes composite create --database=$DATABASE_ID $INDEX_ARGS --async
+    if [ $? -ne 0 ]; then
+        echo "❌ Firestore index creation failed!"
+        exit 1
+    fi
+done <<< "$MISSING_INDEXES"
+
 # Deploy the function
 echo "Deploying function $FUNCTION_NAME to region $REGION..."
 gcloud functions deploy $FUNCTION_NAME \
@@ -39,9 +110,11 @@ gcloud functions deploy $FUNCTION_NAME \
     --memory=$MEMORY \
     --timeout=$TIMEOUT \
     --max-instances=$MAX_INSTANCES \
+    --cpu=$CPU \
+    --concurrency=$CONCURRENCY \
     --trigger-http \
     --allow-unauthenticated \
-    --set-env-vars="API_SECRET_KEY=your-secret-key-change-in-production,GOOGLE_CLOUD_PROJECT=retail-api-397423,FIRESTORE_DATABASE_ID=adagio-teas-visitor-ids,API_TOKENS_SECRET_NAME=adagio-visitorid-fastapi-tokens"
+    --set-env-vars="GOOGLE_CLOUD_PROJECT=retail-api-397423,FIRESTORE_DATABASE_ID=$DATABASE_ID,API_TOKENS_SECRET_NAME=adagio-visitorid-fastapi-tokens,THREADS=$CONCURRENCY"
 
 if [ $? -eq 0 ]; then
     echo "✅ Function deployed successfully!"
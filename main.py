@@ -1,10 +1,16 @@
 import os
 import hashlib
 import hmac
-import json
-from datetime import datetime
-from typing import Optional, Dict
-from flask import Flask, request, jsonify
+import itertools
+import threading
+import time
+from datetime import datetime, timezone
+from http import HTTPStatus
+from typing import Optional, Dict, FrozenSet, List, Tuple
+import orjson
+from cachetools import TTLCache
+from flask import Flask, Response, request
+from werkzeug.exceptions import HTTPException
 from google.cloud import firestore
 from google.cloud import secretmanager
 from functions_framework import http
@@ -17,21 +23,81 @@ logger = logging.getLogger(__name__)
 # Initialize Flask app
 app = Flask(__name__)
 
-# API Key configuration
-API_SECRET_KEY = os.getenv("API_SECRET_KEY", "your-secret-key-change-in-production")
+# Google Cloud configuration
 PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT", "retail-api-397423")
 FIRESTORE_DATABASE_ID = os.getenv("FIRESTORE_DATABASE_ID", "adagio-teas-visitor-ids")
 
 # Secret Manager client
 secret_client = secretmanager.SecretManagerServiceClient()
 
-# Initialize Firestore client
-db = firestore.Client(project=PROJECT_ID, database=FIRESTORE_DATABASE_ID)
+# Initialize a small pool of Firestore clients so concurrent requests are
+# spread across several gRPC channels. Each client already opens its channel
+# with a 30s keepalive, so idle instances reuse their connections.
+FIRESTORE_POOL_SIZE = max(1, int(os.getenv("FIRESTORE_POOL_SIZE", "4")))
+_db_pool = [
+    firestore.Client(project=PROJECT_ID, database=FIRESTORE_DATABASE_ID)
+    for _ in range(FIRESTORE_POOL_SIZE)
+]
+_db_counter = itertools.count()
 
-def get_api_tokens() -> Dict[str, str]:
+def get_db() -> firestore.Client:
+    """Return the next Firestore client from the pool (round-robin)."""
+    return _db_pool[next(_db_counter) % FIRESTORE_POOL_SIZE]
+
+# Token caches: the Secret Manager payload is refreshed every 10 minutes and
+# verified tokens (keyed by SHA-256 digest) are remembered for a minute. The
+# environment fallback used when Secret Manager fails is only kept for a few
+# seconds so the real tokens come back as soon as it recovers.
+_tokens_cache = TTLCache(maxsize=1, ttl=600)
+_fallback_tokens_cache = TTLCache(maxsize=1, ttl=5)
+_verified_cache = TTLCache(maxsize=10000, ttl=60)
+_tokens_lock = threading.Lock()
+_verified_lock = threading.Lock()
+# Bumped on every reload so in-flight checks against the old tokens are not
+# written back into _verified_cache
+_tokens_generation = 0
+
+# Separate credential for the admin endpoints; they are disabled when unset
+ADMIN_API_TOKEN = os.getenv("ADMIN_API_TOKEN", "")
+
+# Successful lookups are cached per user_id; misses are never cached so new
+# records become visible immediately.
+LOOKUP_CACHE_TTL = int(os.getenv("LOOKUP_CACHE_TTL", "300"))
+_lookup_cache = TTLCache(maxsize=50_000, ttl=LOOKUP_CACHE_TTL)
+_lookup_lock = threading.Lock()
+
+# Read visitor records directly by document ID before querying on user_id.
+# Only enable once records are stored with their user_id as the document ID;
+# otherwise every lookup pays for an extra read.
+LOOKUP_BY_DOCUMENT_ID = os.getenv("LOOKUP_BY_DOCUMENT_ID", "False").lower() == "true"
+
+# Batch lookup limits: user_ids per request and values per Firestore "in" query
+MAX_BATCH_SIZE = 500
+_IN_QUERY_LIMIT = 30
+
+def _get_cached_tokens() -> Tuple[FrozenSet[str], bool]:
+    """
+    Return the cached (token set, from Secret Manager) entry, refreshing it
+    when expired.
+    """
+    # TTLCache is not thread-safe; holding the lock also means only one
+    # thread refreshes the cache when it expires
+    with _tokens_lock:
+        entry = _tokens_cache.get("t") or _fallback_tokens_cache.get("t")
+        if entry is None:
+            api_tokens, from_secret_manager = _fetch_api_tokens()
+            entry = (frozenset(api_tokens.values()), from_secret_manager)
+            if from_secret_manager:
+                _tokens_cache["t"] = entry
+            else:
+                _fallback_tokens_cache["t"] = entry
+        return entry
+
+def _fetch_api_tokens() -> Tuple[Dict[str, str], bool]:
     """
     Retrieve API tokens from Google Secret Manager.
-    Returns a dictionary of token names to token values.
+    Returns a dictionary of token names to token values and whether it came
+    from Secret Manager (False when the environment fallback was used).
     """
     try:
         # Get the secret name from environment variable
@@ -43,77 +109,196 @@ def get_api_tokens() -> Dict[str, str]:
         # Access the secret version
         response = secret_client.access_secret_version(request={"name": name})
         
-        # Decode the secret payload
-        secret_payload = response.payload.data.decode("UTF-8")
-        
-        # Parse the JSON payload
-        api_tokens = json.loads(secret_payload)
+        # Parse the JSON payload directly from bytes
+        api_tokens = orjson.loads(response.payload.data)
         
         logger.info("Successfully retrieved API tokens from Secret Manager")
-        return api_tokens
+        return api_tokens, True
         
     except Exception as e:
-        logger.error(f"Failed to retrieve API tokens from Secret Manager: {str(e)}")
+        logger.error("Failed to retrieve API tokens from Secret Manager: %s", e)
         # Fallback to environment variables for local development
         fallback_tokens = {
             "adagio_token_1": os.getenv("API_TOKEN_1", "sk_test_YOUR_TEST_TOKEN_HERE"),
             "adagio_token_2": os.getenv("API_TOKEN_2", "sk_live_YOUR_LIVE_TOKEN_HERE")
         }
         logger.warning("Using fallback API tokens from environment variables")
-        return fallback_tokens
+        return fallback_tokens, False
+
+# Authorization header scheme prefix
+_BEARER = "Bearer "
+_BEARER_LEN = len(_BEARER)
+
+def reload_api_tokens() -> None:
+    """Drop cached tokens so the next request re-reads Secret Manager."""
+    global _tokens_generation
+    with _tokens_lock:
+        _tokens_cache.clear()
+        _fallback_tokens_cache.clear()
+    with _verified_lock:
+        _tokens_generation += 1
+        _verified_cache.clear()
+    logger.info("API token caches cleared")
 
 def verify_api_key(api_key: str) -> bool:
     """
-    Verify API key using checksum verification.
-    This creates a checksum based on the token and secret key.
+    Verify API key against the tokens stored in Secret Manager.
+    Recently verified tokens are remembered by their SHA-256 digest.
     """
-    if not api_key:
-        return False
-    
     # Extract token from API key format
-    if not api_key.startswith("Bearer "):
+    if not api_key or api_key[:_BEARER_LEN] != _BEARER:
         return False
     
-    token = api_key[7:]  # Remove "Bearer " prefix
+    token = api_key[_BEARER_LEN:]
     
-    # Get API tokens from Secret Manager
-    api_tokens = get_api_tokens()
+    # Skip the full check for recently verified tokens
+    token_hash = hashlib.sha256(token.encode()).digest()
+    with _verified_lock:
+        if token_hash in _verified_cache:
+            return True
+        generation = _tokens_generation
     
     # Check if token exists in our valid tokens
-    if token not in api_tokens.values():
+    token_set, from_secret_manager = _get_cached_tokens()
+    if token not in token_set:
         return False
     
-    # Create checksum verification
-    expected_checksum = hmac.new(
-        API_SECRET_KEY.encode(),
-        token.encode(),
-        hashlib.sha256
-    ).hexdigest()
-    
-    # For demo purposes, we'll use a simple verification
-    # In production, you might want to store checksums separately
+    # Tokens accepted by the fallback set are rechecked on every request
+    if from_secret_manager:
+        with _verified_lock:
+            if generation == _tokens_generation:
+                _verified_cache[token_hash] = True
     return True
 
+def orjsonify(payload: dict) -> Response:
+    """Serialize a payload to a JSON response using orjson."""
+    return Response(orjson.dumps(payload), mimetype="application/json")
+
+def _error_body(status_code: int, message: str) -> dict:
+    """Build the JSON error payload for an HTTP status code."""
+    return {"error": HTTPStatus(status_code).phrase, "message": message, "status_code": status_code}
+
+def _now_iso() -> str:
+    """Return the current UTC time as an ISO 8601 string with milliseconds."""
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds")
+
+# Health check timestamp, refreshed at most once per second
+_health_timestamp = ("", 0.0)
+
+def _health_now_iso() -> str:
+    """Return the current UTC timestamp, reusing it for up to one second."""
+    global _health_timestamp
+    timestamp, expires = _health_timestamp
+    now = time.monotonic()
+    if now >= expires:
+        timestamp = _now_iso()
+        _health_timestamp = (timestamp, now + 1.0)
+    return timestamp
+
+def _is_document_id(value) -> bool:
+    """Check whether a value can be used as a Firestore document ID."""
+    return (
+        isinstance(value, str)
+        and value not in ("", ".", "..")
+        and "/" not in value
+        and not (value.startswith("__") and value.endswith("__"))
+        and len(value.encode("utf-8")) <= 1500
+    )
+
+def _snapshot_value(snap, field_path: str):
+    """Read one field from a document snapshot, or None if it is missing."""
+    try:
+        return snap.get(field_path)
+    except KeyError:
+        return None
+
+def lookup_visitor_ids_core(user_ids: List[str], client: firestore.Client) -> Dict[str, Optional[str]]:
+    """
+    Find the visitor records for user IDs in Firestore.
+    Returns a mapping of each found user_id to its visitor_id (None if the
+    record has no visitor_id); user IDs without a record are left out.
+    """
+    collection_ref = client.collection("visitor_ids")
+    found = {}
+    pending = list(dict.fromkeys(user_ids))
+    
+    # Records keyed by user_id are fetched in a single batched read
+    if LOOKUP_BY_DOCUMENT_ID:
+        refs = [collection_ref.document(user_id) for user_id in pending if _is_document_id(user_id)]
+        if refs:
+            for snap in client.get_all(refs, field_paths=["user_id", "visitor_id"]):
+                if snap.exists and _snapshot_value(snap, "user_id") == snap.id:
+                    found[snap.id] = _snapshot_value(snap, "visitor_id")
+        pending = [user_id for user_id in pending if user_id not in found]
+    
+    # Fall back to querying records stored under other document IDs
+    for start in range(0, len(pending), _IN_QUERY_LIMIT):
+        chunk = pending[start:start + _IN_QUERY_LIMIT]
+        # A single user_id takes the first result of an equality query
+        if len(chunk) == 1:
+            query = collection_ref.where("user_id", "==", chunk[0]).select(["visitor_id"]).limit(1)
+            doc = next(iter(query.stream()), None)
+            if doc is not None:
+                found[chunk[0]] = _snapshot_value(doc, "visitor_id")
+            continue
+        
+        # Unbounded: duplicate records for a user_id are all streamed and the
+        # first one wins
+        query = collection_ref.where("user_id", "in", chunk).select(["user_id", "visitor_id"])
+        for doc in query.stream():
+            user_id = _snapshot_value(doc, "user_id")
+            if user_id in chunk and user_id not in found:
+                found[user_id] = _snapshot_value(doc, "visitor_id")
+    
+    return found
+
 def get_api_key():
     """Extract and validate API key from header."""
     authorization = request.headers.get('Authorization')
     if not authorization:
-        return None, jsonify({"error": "Unauthorized", "message": "API key required in Authorization header", "status_code": 401}), 401
+        return None, orjsonify(_error_body(401, "API key required in Authorization header")), 401
     
     if not verify_api_key(authorization):
-        return None, jsonify({"error": "Unauthorized", "message": "Invalid API key", "status_code": 401}), 401
+        return None, orjsonify(_error_body(401, "Invalid API key")), 401
     
     return authorization, None, None
 
+def verify_admin_key(api_key: str) -> bool:
+    """Verify the Authorization header against the admin token."""
+    if not ADMIN_API_TOKEN or not api_key or api_key[:_BEARER_LEN] != _BEARER:
+        return False
+    return hmac.compare_digest(api_key[_BEARER_LEN:].encode(), ADMIN_API_TOKEN.encode())
+
+@app.errorhandler(HTTPException)
+def handle_http_exception(exc: HTTPException):
+    """Return Flask/Werkzeug HTTP errors in the API's JSON error format."""
+    # Keep the headers werkzeug sets on the error (e.g. Allow on 405)
+    response = exc.get_response()
+    response.set_data(orjson.dumps(_error_body(exc.code, exc.description)))
+    response.mimetype = "application/json"
+    return response
+
 @app.route('/')
 def root():
     """Health check endpoint."""
-    return jsonify({"message": "Adagio Visitor ID Lookup API", "status": "healthy"})
+    return orjsonify({"message": "Adagio Visitor ID Lookup API", "status": "healthy"})
 
 @app.route('/health')
 def health_check():
     """Health check endpoint for monitoring."""
-    return jsonify({"status": "healthy", "timestamp": datetime.utcnow().isoformat()})
+    return orjsonify({"status": "healthy", "timestamp": _health_now_iso()})
+
+@app.route('/admin/reload-tokens', methods=['POST'])
+def reload_tokens():
+    """Reload API tokens from Secret Manager after a rotation."""
+    if not ADMIN_API_TOKEN:
+        return orjsonify(_error_body(404, "Admin endpoints are not enabled")), 404
+    
+    if not verify_admin_key(request.headers.get('Authorization')):
+        return orjsonify(_error_body(401, "Invalid admin API key")), 401
+    
+    reload_api_tokens()
+    return orjsonify({"status": "reloaded", "reloaded_at": _now_iso()})
 
 @app.route('/lookup', methods=['POST'])
 def lookup_visitor_id():
@@ -134,51 +319,133 @@ def lookup_visitor_id():
     try:
         # Get user_id from request
         data = request.get_json()
-        if not data or 'user_id' not in data:
-            return jsonify({"error": "Bad Request", "message": "user_id is required", "status_code": 400}), 400
+        if not isinstance(data, dict) or 'user_id' not in data:
+            return orjsonify(_error_body(400, "user_id is required")), 400
         
         user_id = data['user_id']
-        logger.info(f"Looking up visitor ID for user_id: {user_id}")
+        if not isinstance(user_id, str) or not user_id:
+            return orjsonify(_error_body(400, "user_id must be a non-empty string")), 400
         
-        # Query Firestore for the document with user_id
-        collection_ref = db.collection("visitor_ids")
-        query = collection_ref.where("user_id", "==", user_id).limit(1)
-        docs = query.stream()
+        logger.info("Looking up visitor ID for user_id: %s", user_id)
         
-        # Check if document exists
-        doc_found = False
-        visitor_id = None
+        # Serve repeat lookups from the cache
+        with _lookup_lock:
+            visitor_id = _lookup_cache.get(user_id)
+        if visitor_id is not None:
+            return orjsonify({
+                "visitor_id": visitor_id,
+                "user_id": user_id,
+                "found_at": _now_iso()
+            })
         
-        for doc in docs:
-            doc_found = True
-            data = doc.to_dict()
-            visitor_id = data.get("visitor_id")
-            logger.info(f"Found visitor_id: {visitor_id} for user_id: {user_id}")
-            break
+        found = lookup_visitor_ids_core([user_id], get_db())
         
-        if not doc_found:
-            logger.warning(f"No visitor ID found for user_id: {user_id}")
-            return jsonify({"error": "Not Found", "message": f"No visitor ID found for user_id: {user_id}", "status_code": 404}), 404
+        if user_id not in found:
+            logger.warning("No visitor ID found for user_id: %s", user_id)
+            return orjsonify(_error_body(404, f"No visitor ID found for user_id: {user_id}")), 404
         
+        visitor_id = found[user_id]
         if not visitor_id:
-            logger.error(f"Visitor ID field missing for user_id: {user_id}")
-            return jsonify({"error": "Internal Server Error", "message": "Visitor ID field missing in database record", "status_code": 500}), 500
+            logger.error("Visitor ID field missing for user_id: %s", user_id)
+            return orjsonify(_error_body(500, "Visitor ID field missing in database record")), 500
         
-        return jsonify({
+        logger.info("Found visitor_id: %s for user_id: %s", visitor_id, user_id)
+        with _lookup_lock:
+            _lookup_cache[user_id] = visitor_id
+        
+        return orjsonify({
             "visitor_id": visitor_id,
             "user_id": user_id,
-            "found_at": datetime.utcnow().isoformat()
+            "found_at": _now_iso()
+        })
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Error looking up visitor ID for user_id %s: %s", user_id, e)
+        return orjsonify(_error_body(500, "Internal server error during lookup")), 500
+
+@app.route('/lookup/batch', methods=['POST'])
+def lookup_visitor_ids_batch():
+    """
+    Lookup visitor IDs for several user IDs in one request.
+    
+    Returns:
+        JSON response with a result per user_id (visitor_id is null when
+        not found) and a timestamp
+        
+    Raises:
+        400 for an invalid user_ids list, 500 for server errors
+    """
+    # Check API key
+    api_key, error_response, status_code = get_api_key()
+    if error_response:
+        return error_response, status_code
+    
+    # Get user_ids from request
+    data = request.get_json()
+    user_ids = data.get('user_ids') if isinstance(data, dict) else None
+    if not isinstance(user_ids, list) or not user_ids:
+        return orjsonify(_error_body(400, "user_ids must be a non-empty list")), 400
+    
+    if len(user_ids) > MAX_BATCH_SIZE:
+        return orjsonify(_error_body(400, f"At most {MAX_BATCH_SIZE} user_ids per request")), 400
+    
+    if not all(isinstance(user_id, str) and user_id for user_id in user_ids):
+        return orjsonify(_error_body(400, "user_ids must be non-empty strings")), 400
+    
+    try:
+        logger.info("Looking up visitor IDs for %d user_ids", len(user_ids))
+        
+        # Serve repeat lookups from the cache
+        found = {}
+        with _lookup_lock:
+            for user_id in user_ids:
+                visitor_id = _lookup_cache.get(user_id)
+                if visitor_id is not None:
+                    found[user_id] = visitor_id
+        missing = [user_id for user_id in dict.fromkeys(user_ids) if user_id not in found]
+        
+        if missing:
+            for user_id, visitor_id in lookup_visitor_ids_core(missing, get_db()).items():
+                if not visitor_id:
+                    # Reported as not found rather than failing the whole batch
+                    logger.error("Visitor ID field missing for user_id: %s", user_id)
+                    continue
+                found[user_id] = visitor_id
+            
+            with _lookup_lock:
+                for user_id in missing:
+                    if user_id in found:
+                        _lookup_cache[user_id] = found[user_id]
+        
+        return orjsonify({
+            "results": [
+                {"user_id": user_id, "visitor_id": found.get(user_id)}
+                for user_id in user_ids
+            ],
+            "found_at": _now_iso()
         })
         
     except Exception as e:
-        logger.error(f"Error looking up visitor ID for user_id {user_id}: {str(e)}")
-        return jsonify({"error": "Internal Server Error", "message": "Internal server error during lookup", "status_code": 500}), 500
+        logger.error("Error looking up visitor IDs for %d user_ids: %s", len(user_ids), e)
+        return orjsonify(_error_body(500, "Internal server error during lookup")), 500
 
 # Google Cloud Functions entry point
 @http
 def main(request):
     """Entry point for Google Cloud Functions."""
-    return app(request.environ, lambda *args: None)
+    # Dispatch through the app's routing so status codes and headers are kept
+    with app.request_context(request.environ):
+        try:
+            return app.full_dispatch_request()
+        except Exception as e:
+            # Same 500 handling the WSGI path applies to unhandled errors
+            return app.handle_exception(e)
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8080, debug=True)
\ No newline at end of file
+    app.run(
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8080")),
+        debug=os.getenv("DEBUG", "False").lower() == "true"
+    )
\ No newline at end of file